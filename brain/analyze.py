@@ -1,17 +1,46 @@
 import os
+import math
 import time
+import asyncio
+import threading
 import json
 import logging
 import sys
+import signal
+import sqlite3
+import random
+import bisect
+import hashlib
+import functools
+import itertools
 import subprocess
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from string import Template
+import httpx
 from google import genai
 from google.genai import types
-from watchdog.observers.polling import PollingObserver as Observer
-from watchdog.events import FileSystemEventHandler
+from watchfiles import Change, watch
 from pythonjsonlogger import jsonlogger
 from dotenv import load_dotenv
 from bgm_generator import generate_bgm_with_gemini
+from batch import BatchQueue
+
+try:
+    import orjson
+
+    def json_loads(text):
+        return orjson.loads(text)
+
+    def json_dumps_pretty(data):
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+except ImportError:
+    def json_loads(text):
+        return json.loads(text)
+
+    def json_dumps_pretty(data):
+        return json.dumps(data, indent=2, ensure_ascii=False).encode("utf-8")
 
 # Load env
 load_dotenv()
@@ -28,9 +57,43 @@ logger.setLevel(logging.INFO)
 RAW_DIR = "/app/data/raw"
 JSON_DIR = "/app/data/json"
 BGM_DIR = "/app/data/bgm"
+DB_PATH = "/app/data/trends.db"
+# Gemini analyses keyed by video content hash; muscle only watches JSON_DIR itself
+ANALYSIS_CACHE_DIR = os.path.join(JSON_DIR, ".cache")
+ANALYSIS_CACHE_MAX = int(os.environ.get("ANALYSIS_CACHE_MAX", "500"))
 API_KEY = os.environ.get("GEMINI_API_KEY")
 # User requested specific model name
 MODEL_NAME = os.environ.get("GEMINI_MODEL", "gemini-2.5-flash")
+# Worker threads for blocking SDK/DB calls made from the event loop
+BRAIN_WORKERS = int(os.environ.get("BRAIN_WORKERS", "4"))
+# Seconds to wait for Gemini to finish processing an upload
+FILE_READY_TIMEOUT = float(os.environ.get("FILE_READY_TIMEOUT", "600"))
+# Upper bound on concurrent HTTP connections to the Gemini API
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "32"))
+# Number of videos allowed in flight with Gemini at once
+MAX_CONCURRENT_UPLOADS = int(os.environ.get("MAX_CONCURRENT_UPLOADS", str(BRAIN_WORKERS)))
+
+# Batch mode: BATCH_MAX > 1 sends analyses through the Gemini Batch API, flushed when
+# BATCH_MAX requests are queued or the oldest has waited BATCH_FLUSH_SEC seconds
+BATCH_MAX = int(os.environ.get("BATCH_MAX", "1"))
+BATCH_FLUSH_SEC = float(os.environ.get("BATCH_FLUSH_SEC", "30"))
+
+# Seconds a fetched trending style is reused before re-reading trends.db
+STYLE_CACHE_TTL = float(os.environ.get("STYLE_CACHE_TTL", "60"))
+
+# A new video is processed once its size is unchanged for SETTLE_SAMPLES checks
+SETTLE_INTERVAL = 0.5
+SETTLE_SAMPLES = 2
+
+# Passed to the upload explicitly: mimetypes does not know .mkv on slim images
+VIDEO_MIME_TYPES = {
+    ".mp4": "video/mp4", ".mov": "video/quicktime",
+    ".avi": "video/x-msvideo", ".mkv": "video/x-matroska",
+}
+VIDEO_EXTS = frozenset(VIDEO_MIME_TYPES)
+
+# inotify does not see writes made by other hosts on network filesystems
+NETWORK_FS_TYPES = ("nfs", "nfs4", "cifs", "smb3", "smbfs")
 
 # Ensure BGM directory exists
 os.makedirs(BGM_DIR, exist_ok=True) 
@@ -39,287 +102,742 @@ client = None
 if not API_KEY:
     logger.warning("GEMINI_API_KEY is not set. Brain service will not function correctly.", extra={"event": "config_warning"})
 else:
-    client = genai.Client(api_key=API_KEY)
+    # One client shared by all workers; keep enough pooled connections for every worker thread
+    client = genai.Client(
+        api_key=API_KEY,
+        http_options=types.HttpOptions(
+            client_args={"limits": httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=BRAIN_WORKERS * 2)},
+            retry_options=types.HttpRetryOptions(attempts=3),
+        ),
+    )
 
-class VideoHandler(FileSystemEventHandler):
-    def on_created(self, event):
-        if event.is_directory:
-            return
-        
-        filepath = event.src_path
+# Gemini prompt, parsed once; only the per-video fields are spliced in.
+# string.Template keeps the JSON example free of doubled braces.
+PROMPT_TEMPLATE = Template("""
+Analyze this video.
+${script_context}
+${style_context}
+
+${audio_analysis}
+
+Output a JSON object with the following structure:
+{
+    "cuts": [
+        {
+            "start_time": "HH:MM:SS",
+            "end_time": "HH:MM:SS",
+            "description": "Short description",
+            "filter": "none",  # Always use 'none' to disable filters
+            "transition_type": "fade/wipeleft/slideup/circleopen (default: ${transition_type})",
+            "focus_point": 0.5,
+            "caption": "Short, punchy text overlay (e.g. 'WOW!', 'Nice!')",
+            "caption_style": {
+                "font": "sans/serif/handwriting (default: ${caption_style})",
+                "color": "white/yellow/cyan",
+                "position": "bottom/center/top",
+                "box": true/false,
+                "background_asset": "simple_box/news_ticker/none (choose appropriate style)"
+            }
+        }
+    ],
+    "editing_style": {
+        "tempo": "fast/slow/dynamic",
+        "mood": "exciting/calm/etc"
+    },
+    "se_events": [
+        {
+            "timestamp": "HH:MM:SS",
+            "type": "impact/whoosh/laugh/correct/incorrect (e.g. use 'impact' for Emphasis)",
+            "tag": "funny/serious/etc"
+        }
+    ],
+    "visual_effects": [
+        {
+            "start": "HH:MM:SS",
+            "end": "HH:MM:SS",
+            "type": "zoom_in/pan_left/pan_right/zoom_out",
+            "speed": "slow/fast (default: fast for zoom_in, slow for pan)"
+        }
+    ],
+    "thumbnail": {
+        "timestamp": "HH:MM:SS (Best frame for clickbait)",
+        "text": "Short Uppercase Title (e.g. SHOCKING!)",
+        "color": "red/yellow/white"
+    }
+}
+
+
+# New SDK usage for generation
+Focus on identifying excitement points and editing style.
+IMPORTANT: 
+1. Do not caption every single segment. Be selective. Prioritize reactions.
+2. ADD SOUND EFFECTS (SE) where appropriate.
+3. ADD VISUAL EFFECTS (Zoom/Pan).
+4. THUMBNAIL: Choose the most expressive/shocking frame and a short punchy title.
+5. VERTICAL CROP: For each cut, determine the `focus_point` (0.0-1.0) where the subject is located horizontally. 0.5 is center.
+Ensure strict JSON output.
+""")
+
+STYLE_TEMPLATE = Template("""
+APPLY THIS TRENDING STYLE:
+- Cuts/Min aim: ${cuts_per_min}
+- Filter: ${filter_usage}
+- Transition: ${transition_type}
+- Caption Style: ${caption_style}
+""")
+
+SCRIPT_TEMPLATE = Template("""
+USER PROVIDED SCRIPT/TRANSCRIPT:
+${script}
+
+Use this to better understand timing and context.
+""")
+
+AUDIO_ANALYSIS_PROMPT = "AUDIO ANALYSIS: Identify moments for sound effects based on speech emphasis, laughter, pauses, and reactions."
+
+# Professional BGM Library (Kevin MacLeod)
+BGM_LIBRARY = {
+    "energetic": [
+        "energetic_pro.mp3", "Monkeys_Spinning_Monkeys.mp3", "Fluffing_a_Duck.mp3",
+        "Run_Amok.mp3", "Swing_Machine.mp3", "The_Builder.mp3", "Pixel_Peeker_Polka_faster.mp3"
+    ],
+    "upbeat": [
+        "upbeat_pro.mp3", "New_Friendly.mp3", "Carefree.mp3", "Sneaky_Snitch.mp3",
+        "Scheming_Weasel_faster.mp3"
+    ],
+    "calm": [
+        "calm_pro.mp3", "Easy_Lemon.mp3", "Sheep_May_Safely_Graze.mp3",
+        "Dreams_Become_Real.mp3", "Almost_Bliss.mp3", "Local_Forecast_Elevator.mp3"
+    ],
+    "dramatic": [
+        "dramatic_pro.mp3", "Volatile_Reaction.mp3", "The_Complex.mp3",
+        "Hitman.mp3", "Day_of_Chaos.mp3", "Sneaky_Adventure.mp3"
+    ],
+    "happy": [
+        "happy_pro.mp3", "Carefree.mp3", "Fluffing_a_Duck.mp3", "Monkeys_Spinning_Monkeys.mp3"
+    ]
+}
+
+# Map specific keywords to categories
+MOOD_CATEGORY_MAP = {
+    "exciting": "energetic", "fun": "energetic", "peaceful": "calm",
+    "relaxing": "calm", "serious": "dramatic", "mysterious": "dramatic",
+    "cheerful": "happy", "positive": "upbeat"
+}
+
+# Every exact mood we can resolve without scanning: category names map to themselves
+MOOD_TO_CATEGORY = {
+    **{category: category for category in BGM_LIBRARY},
+    **{mood: category for mood, category in MOOD_CATEGORY_MAP.items() if category in BGM_LIBRARY},
+    "quiet": "calm", "sad": "dramatic", "dark": "dramatic",
+}
+
+@functools.lru_cache(maxsize=256)
+def mood_category(mood):
+    """Resolve a free-form mood to a BGM_LIBRARY category"""
+    category = MOOD_TO_CATEGORY.get(mood)
+    if category:
+        return category
+    # Gemini sometimes answers with phrases ("calm and warm"); fall back to keywords
+    if "calm" in mood or "quiet" in mood: return "calm"
+    if "sad" in mood or "dark" in mood: return "dramatic"
+    return "energetic" # Default
+
+_bgm_index = None
+
+def bgm_index():
+    """Map each BGM_LIBRARY category to the tracks present in BGM_DIR, built once"""
+    global _bgm_index
+    index = _bgm_index
+    if index is None:
+        present = set(os.listdir(BGM_DIR))
+        index = _bgm_index = {
+            category: [t for t in tracks if t in present]
+            for category, tracks in BGM_LIBRARY.items()
+        }
+    return index
+
+def invalidate_bgm_index():
+    global _bgm_index
+    _bgm_index = None
+
+def watch_bgm_dir(polling):
+    """Rebuild the BGM index whenever files in BGM_DIR change"""
+    for _ in watch(BGM_DIR, force_polling=polling, recursive=False):
+        invalidate_bgm_index()
+
+# Structured output schema mirroring PROMPT_TEMPLATE; required fields match what muscle deserializes
+ANALYSIS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "cuts": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "start_time": {"type": "STRING"},
+                    "end_time": {"type": "STRING"},
+                    "description": {"type": "STRING"},
+                    "filter": {"type": "STRING"},
+                    "transition_type": {"type": "STRING"},
+                    "focus_point": {"type": "NUMBER"},
+                    "caption": {"type": "STRING"},
+                    "caption_style": {
+                        "type": "OBJECT",
+                        "properties": {
+                            "font": {"type": "STRING"},
+                            "color": {"type": "STRING"},
+                            "position": {"type": "STRING"},
+                            "box": {"type": "BOOLEAN"},
+                            "background_asset": {"type": "STRING"},
+                        },
+                    },
+                },
+                "required": ["start_time", "end_time", "filter"],
+            },
+        },
+        "editing_style": {
+            "type": "OBJECT",
+            "properties": {
+                "tempo": {"type": "STRING"},
+                "mood": {"type": "STRING"},
+            },
+        },
+        "se_events": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "timestamp": {"type": "STRING"},
+                    "type": {"type": "STRING"},
+                    "tag": {"type": "STRING"},
+                },
+                "required": ["timestamp", "type"],
+            },
+        },
+        "visual_effects": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "start": {"type": "STRING"},
+                    "end": {"type": "STRING"},
+                    "type": {"type": "STRING"},
+                    "speed": {"type": "STRING"},
+                },
+                "required": ["start", "end", "type"],
+            },
+        },
+        "thumbnail": {
+            "type": "OBJECT",
+            "properties": {
+                "timestamp": {"type": "STRING"},
+                "text": {"type": "STRING"},
+                "color": {"type": "STRING"},
+            },
+            "required": ["timestamp", "text"],
+        },
+    },
+    "required": ["cuts", "editing_style"],
+}
+
+# Built once and shared by every generate_content call
+GEN_CONFIG = types.GenerateContentConfig(
+    response_mime_type="application/json",
+    response_schema=ANALYSIS_SCHEMA,
+)
+
+batch_queue = None
+if client and BATCH_MAX > 1:
+    batch_queue = BatchQueue(
+        client, MODEL_NAME, BATCH_MAX, BATCH_FLUSH_SEC,
+        generation_config={"response_mime_type": "application/json", "response_schema": ANALYSIS_SCHEMA},
+    )
+
+# Fallbacks for style fields the prompt mentions
+PROMPT_DEFAULTS = {"transition_type": "fade", "caption_style": "sans"}
+# Style columns spliced into the prompt, and so part of the analysis cache key
+STYLE_PROMPT_FIELDS = ("cuts_per_min", "filter_usage", "transition_type", "caption_style")
+
+class VideoHandler:
+    """Debounces detected videos and runs process_video for them on the event loop"""
+    def __init__(self, loop):
+        self.loop = loop
+        # A batch can only fill up if enough videos are allowed to wait on it at once
+        self.semaphore = asyncio.Semaphore(max(MAX_CONCURRENT_UPLOADS, BATCH_MAX))
+        # filepath -> (last seen size, consecutive unchanged samples)
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        threading.Thread(target=self._settle_loop, name="brain-settle", daemon=True).start()
+
+    def dispatch_path(self, filepath):
         filename = os.path.basename(filepath)
         
-        if not filename.lower().endswith(('.mp4', '.mov', '.avi', '.mkv')):
+        if not is_video(filename):
             return
 
-        logger.info(f"New video detected", extra={"event": "file_detected", "file_name": filename})
-        try:
-            self.process_video(filepath, filename)
-        except Exception as e:
-            logger.error(f"Error processing video", extra={"event": "process_error", "file_name": filename, "error": str(e)})
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("New video detected", extra={"event": "file_detected", "file_name": filename})
+        # The file may still be being written; _settle_loop dispatches it once its size is stable
+        with self.pending_lock:
+            self.pending.setdefault(filepath, (-1, 0))
 
-    def process_video(self, filepath, filename):
-        if not client:
-            logger.error("Client not initialized", extra={"event": "client_error"})
-            return
+    def _settle_loop(self):
+        while True:
+            time.sleep(SETTLE_INTERVAL)
+            ready = []
+            with self.pending_lock:
+                for filepath, (last_size, stable) in list(self.pending.items()):
+                    try:
+                        size = os.path.getsize(filepath)
+                    except OSError:
+                        # Removed before it settled
+                        del self.pending[filepath]
+                        continue
+                    stable = stable + 1 if size == last_size else 0
+                    if stable >= SETTLE_SAMPLES:
+                        del self.pending[filepath]
+                        ready.append(filepath)
+                    else:
+                        self.pending[filepath] = (size, stable)
 
-        # Load metadata if exists
-        metadata = load_metadata(filepath)
-        
-        logger.info("Uploading to Gemini", extra={"event": "upload_start", "file_name": filename, "has_metadata": metadata is not None})
-        
-        try:
-            # Upload file
-            video_file = client.files.upload(file=filepath)
-            
-            # Wait for processing
-            while video_file.state.name == "PROCESSING":
-                time.sleep(2)
-                video_file = client.files.get(name=video_file.name)
-
-            if video_file.state.name == "FAILED":
-                raise ValueError(f"Video processing failed: {video_file.state.name}")
-
-            logger.info("Video processed by Gemini", extra={"event": "upload_complete", "file_name": filename})
-
-            # Fetch trending style
-            style_context = ""
-            bgm_path = None
+            for filepath in ready:
+                # Hand off to the event loop so the watcher is never blocked
+                asyncio.run_coroutine_threadsafe(self._process_async(filepath, os.path.basename(filepath)), self.loop)
+
+    async def _process_async(self, filepath, filename):
+        async with self.semaphore:
             try:
-                style, bgm_path = fetch_latest_style()
-                if style:
-                    style_context = f"""
-                    APPLY THIS TRENDING STYLE:
-                    - Cuts/Min aim: {style.get('cuts_per_min')}
-                    - Filter: {style.get('filter_usage')}
-                    - Transition: {style.get('transition_type')}
-                    - Caption Style: {style.get('caption_style')}
-                    """
+                await process_video(filepath, filename)
             except Exception as e:
-                logger.error(f"Failed to fetch style: {e}")
-
-            # Prepare script context if provided
-            script_context = ""
-            if metadata and metadata.get("script"):
-                script_context = f"""
-                USER PROVIDED SCRIPT/TRANSCRIPT:
-                {metadata['script']}
-                
-                Use this to better understand timing and context.
-                """
-            
-            # Check options
-            options = metadata.get("options", {}) if metadata else {}
-            auto_sound_effects = options.get("auto_sound_effects", False)
-            generate_bgm = options.get("generate_bgm", False)
-            
-            # Generate content
-            prompt = f"""
-            Analyze this video.
-            {script_context} 
-            {style_context}
-            
-            {'AUDIO ANALYSIS: Identify moments for sound effects based on speech emphasis, laughter, pauses, and reactions.' if auto_sound_effects else ''}
-            
-            Output a JSON object with the following structure:
-            {{
-                "cuts": [
-                    {{
-                        "start_time": "HH:MM:SS",
-                        "end_time": "HH:MM:SS",
-                        "description": "Short description",
-                        "filter": "none",  # Always use 'none' to disable filters
-                        "transition_type": "fade/wipeleft/slideup/circleopen (default: {style.get('transition_type', 'fade')})",
-                        "focus_point": 0.5,
-                        "caption": "Short, punchy text overlay (e.g. 'WOW!', 'Nice!')",
-                        "caption_style": {{
-                            "font": "sans/serif/handwriting (default: {style.get('caption_style', 'sans')})",
-                            "color": "white/yellow/cyan",
-                            "position": "bottom/center/top",
-                            "box": true/false,
-                            "background_asset": "simple_box/news_ticker/none (choose appropriate style)"
-                        }}
-                    }}
-                ],
-                "editing_style": {{
-                    "tempo": "fast/slow/dynamic",
-                    "mood": "exciting/calm/etc"
-                }},
-                "se_events": [
-                    {{
-                        "timestamp": "HH:MM:SS",
-                        "type": "impact/whoosh/laugh/correct/incorrect (e.g. use 'impact' for Emphasis)",
-                        "tag": "funny/serious/etc"
-                    }}
-                ],
-                "visual_effects": [
-                    {{
-                        "start": "HH:MM:SS",
-                        "end": "HH:MM:SS",
-                        "type": "zoom_in/pan_left/pan_right/zoom_out",
-                        "speed": "slow/fast (default: fast for zoom_in, slow for pan)"
-                    }}
-                ],
-                "thumbnail": {{
-                    "timestamp": "HH:MM:SS (Best frame for clickbait)",
-                    "text": "Short Uppercase Title (e.g. SHOCKING!)",
-                    "color": "red/yellow/white"
-                }}
-            }}
-
-            
-            # New SDK usage for generation
-            Focus on identifying excitement points and editing style.
-            IMPORTANT: 
-            1. Do not caption every single segment. Be selective. Prioritize reactions.
-            2. ADD SOUND EFFECTS (SE) where appropriate.
-            3. ADD VISUAL EFFECTS (Zoom/Pan).
-            4. THUMBNAIL: Choose the most expressive/shocking frame and a short punchy title.
-            5. VERTICAL CROP: For each cut, determine the `focus_point` (0.0-1.0) where the subject is located horizontally. 0.5 is center.
-            Ensure strict JSON output.
-            """
-            response = client.models.generate_content(
-                model=MODEL_NAME,
-                contents=[video_file, prompt],
-                config=types.GenerateContentConfig(response_mime_type="application/json")
-            )
-            
-            text = response.text.strip()
-            # Cleanup markdown if present (though response_mime_type should prevent it)
-            if text.startswith("```json"):
-                text = text[7:-3]
-            elif text.startswith("```"):
-                text = text[3:-3]
-
-            data = json.loads(text)
-            
-            # Merge manual instructions if provided
-            if metadata and metadata.get("manual_instructions"):
-                data = merge_instructions(data, metadata["manual_instructions"])
+                logger.error("Error processing video", extra={"event": "process_error", "file_name": filename, "error": str(e)})
+
+async def process_video(filepath, filename):
+    try:
+        output_path = os.path.join(JSON_DIR, f"{filename}.json")
+
+        # Re-touched or re-swept file whose inputs are unchanged: nothing to do
+        fingerprint, mtime = await asyncio.to_thread(fingerprint_file, filepath)
+        if os.path.exists(output_path) and await asyncio.to_thread(is_processed, filepath, fingerprint):
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Already processed", extra={"event": "already_processed", "file_name": filename})
+            return
+
+        # Hash the video while the metadata sidecar (if any) and trending style are read
+        video_hash, metadata, (style, _) = await asyncio.gather(
+            asyncio.to_thread(hash_file, filepath),
+            asyncio.to_thread(load_metadata, filepath),
+            asyncio.to_thread(fetch_latest_style),
+        )
+
+        # Identical video analysed under the same prompt: skip Gemini entirely
+        cache_key = analysis_cache_key(video_hash, metadata, style)
+        data = await asyncio.to_thread(load_cached_analysis, cache_key)
+        if data is not None:
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Reusing cached analysis", extra={"event": "cache_hit", "file_name": filename, "video_hash": video_hash, "cache_key": cache_key})
+        else:
+            if not client:
+                logger.error("Client not initialized", extra={"event": "client_error"})
+                return
+            data = await analyze_with_gemini(filepath, filename, metadata, video_hash, style)
+            await asyncio.to_thread(store_cached_analysis, cache_key, data)
+
+        # Merge manual instructions if provided
+        if metadata and metadata.get("manual_instructions"):
+            data = merge_instructions(data, metadata["manual_instructions"])
+            if logger.isEnabledFor(logging.INFO):
                 logger.info("Merged manual instructions", extra={"event": "instructions_merged"})
-            
-            # Generate BGM if requested
-            # Select professional BGM based on video mood
-            mood = data.get("editing_style", {}).get("mood", "").lower()
-            
-            # Professional BGM Library (Kevin MacLeod)
-            bgm_library = {
-                "energetic": [
-                    "energetic_pro.mp3", "Monkeys_Spinning_Monkeys.mp3", "Fluffing_a_Duck.mp3", 
-                    "Run_Amok.mp3", "Swing_Machine.mp3", "The_Builder.mp3", "Pixel_Peeker_Polka_faster.mp3"
-                ],
-                "upbeat": [
-                    "upbeat_pro.mp3", "New_Friendly.mp3", "Carefree.mp3", "Sneaky_Snitch.mp3", 
-                    "Scheming_Weasel_faster.mp3"
-                ],
-                "calm": [
-                    "calm_pro.mp3", "Easy_Lemon.mp3", "Sheep_May_Safely_Graze.mp3", 
-                    "Dreams_Become_Real.mp3", "Almost_Bliss.mp3", "Local_Forecast_Elevator.mp3"
-                ],
-                "dramatic": [
-                    "dramatic_pro.mp3", "Volatile_Reaction.mp3", "The_Complex.mp3", 
-                    "Hitman.mp3", "Day_of_Chaos.mp3", "Sneaky_Adventure.mp3"
-                ],
-                "happy": [
-                    "happy_pro.mp3", "Carefree.mp3", "Fluffing_a_Duck.mp3", "Monkeys_Spinning_Monkeys.mp3"
-                ]
-            }
-            
-            # Map specific keywords to categories
-            mood_category_map = {
-                "exciting": "energetic", "fun": "energetic", "peaceful": "calm", 
-                "relaxing": "calm", "serious": "dramatic", "mysterious": "dramatic", 
-                "cheerful": "happy", "positive": "upbeat"
-            }
-            
-            # Determine category
-            category = mood_category_map.get(mood, mood)
-            if category not in bgm_library:
-                if "calm" in mood or "quiet" in mood: category = "calm"
-                elif "sad" in mood or "dark" in mood: category = "dramatic"
-                else: category = "energetic" # Default
-            
-            # Select random track from category
-            import random
-            available_tracks = bgm_library.get(category, bgm_library["energetic"])
-            
-            # Filter to ensure file exists
-            valid_tracks = [t for t in available_tracks if os.path.exists(os.path.join(BGM_DIR, t))]
-            if not valid_tracks: valid_tracks = ["default_bgm.mp3"]
-            
-            bgm_filename = random.choice(valid_tracks)
-            bgm_path = os.path.join(BGM_DIR, bgm_filename)
-            
-            data["bgm_path"] = bgm_path
-            logger.info(f"Selected BGM: {bgm_filename} for mood: {mood} (category: {category})", 
-                       extra={"event": "bgm_selected", "mood": mood, "bgm": bgm_filename})
-            
-            data["original_filename"] = filename
-            
-            output_path = os.path.join(JSON_DIR, f"{filename}.json")
-            with open(output_path, "w") as f:
-                json.dump(data, f, indent=2)
-            
-            logger.info("Analysis saved", extra={"event": "analysis_saved", "path": output_path})
-            
-            # Cleanup remote file
-            try:
-                client.files.delete(name=video_file.name)
-            except:
-                pass
-            
-        except Exception as e:
-            logger.error("Failed to process with Gemini", extra={"event": "gemini_error", "error": str(e)})
-            raise e
 
-def fetch_latest_style():
-    db_path = "/app/data/trends.db"
-    if not os.path.exists(db_path):
-        return None, None
-        
-    import sqlite3
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
+        # Generate BGM if requested
+        # Select professional BGM based on video mood
+        mood = data.get("editing_style", {}).get("mood", "").lower()
+
+        # Determine category
+        category = mood_category(mood)
+
+        # Select random track from category, among the files actually present
+        valid_tracks = bgm_index().get(category) or ["default_bgm.mp3"]
+
+        bgm_filename = random.choice(valid_tracks)
+        bgm_path = os.path.join(BGM_DIR, bgm_filename)
+
+        data["bgm_path"] = bgm_path
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Selected BGM: %s for mood: %s (category: %s)", bgm_filename, mood, category,
+                        extra={"event": "bgm_selected", "mood": mood, "bgm": bgm_filename})
+
+        data["original_filename"] = filename
+
+        # Write then rename so muscle never reads a half-written file
+        tmp_path = output_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(json_dumps_pretty(data))
+        os.replace(tmp_path, output_path)
+        await asyncio.to_thread(mark_processed, filepath, fingerprint, mtime)
+
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Analysis saved", extra={"event": "analysis_saved", "path": output_path, "video_hash": video_hash})
+
+    except Exception as e:
+        logger.error("Failed to process with Gemini", extra={"event": "gemini_error", "error": str(e)})
+        raise e
+
+
+async def wait_for_file_ready(video_file, timeout=FILE_READY_TIMEOUT):
+    """Poll an uploaded file until Gemini finishes processing it, backing off between probes"""
+    deadline = time.monotonic() + timeout
+    delay = 0.2
+    while video_file.state.name == "PROCESSING":
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"Gemini did not finish processing {video_file.name} within {timeout}s")
+        await asyncio.sleep(delay)
+        delay = min(delay * 1.5, 2.0)
+        video_file = await asyncio.to_thread(client.files.get, name=video_file.name)
+
+    if video_file.state.name == "FAILED":
+        raise ValueError(f"Video processing failed: {video_file.state.name}")
+    return video_file
+
+async def analyze_with_gemini(filepath, filename, metadata, video_hash, style):
+    """Upload the video to Gemini and return the parsed analysis"""
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Uploading to Gemini", extra={"event": "upload_start", "file_name": filename, "video_hash": video_hash, "has_metadata": metadata is not None})
+
+    # The content hash is attached so remote files can be matched to cache entries.
+    # The SDK streams the path in 8 MiB resumable chunks, so memory stays flat.
+    upload_config = {
+        "display_name": video_hash,
+        "mime_type": VIDEO_MIME_TYPES.get(os.path.splitext(filepath)[1].lower(), "video/mp4"),
+    }
+    video_file = await asyncio.to_thread(client.files.upload, file=filepath, config=upload_config)
+
+    video_file = await wait_for_file_ready(video_file)
+
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Video processed by Gemini", extra={"event": "upload_complete", "file_name": filename})
+
+    # Apply trending style
+    prompt_fields = defaultdict(lambda: "none", PROMPT_DEFAULTS)
+    style_context = ""
+    if style:
+        prompt_fields.update(style)
+        style_context = STYLE_TEMPLATE.safe_substitute(prompt_fields)
+
+    # Prepare script context if provided
+    script_context = ""
+    if metadata and metadata.get("script"):
+        script_context = SCRIPT_TEMPLATE.safe_substitute(script=metadata["script"])
+
+    # Check options
+    options = metadata.get("options", {}) if metadata else {}
+    auto_sound_effects = options.get("auto_sound_effects", False)
+    generate_bgm = options.get("generate_bgm", False)
+
+    # Generate content
+    prompt_fields["script_context"] = script_context
+    prompt_fields["style_context"] = style_context
+    prompt_fields["audio_analysis"] = AUDIO_ANALYSIS_PROMPT if auto_sound_effects else ""
+    prompt = PROMPT_TEMPLATE.safe_substitute(prompt_fields)
+    if batch_queue:
+        text = await asyncio.wrap_future(batch_queue.submit(video_file, prompt))
+    else:
+        response = await asyncio.to_thread(
+            client.models.generate_content,
+            model=MODEL_NAME,
+            contents=[video_file, prompt],
+            config=GEN_CONFIG
+        )
+        text = response.text
+
     try:
-        # Get latest style
-        cursor.execute("SELECT * FROM styles ORDER BY created_at DESC LIMIT 1")
-        style = cursor.fetchone()
-        
-        bgm_path = None
-        if style:
-            # Try to find matching BGM
-            bgm_mood = style['bgm_mood']
-            if bgm_mood:
-                cursor.execute("SELECT path FROM assets WHERE type='bgm' AND tags LIKE ? ORDER BY RANDOM() LIMIT 1", (f"%{bgm_mood}%",))
-                bgm = cursor.fetchone()
-                if bgm:
-                    bgm_path = bgm['path']
-        
-        return dict(style) if style else None, bgm_path
-    
+        data = json_loads(text)
+    except ValueError:
+        # Cleanup markdown if present (the response schema should prevent it)
+        text = text.lstrip()
+        if text[:7] == "```json":
+            text = text[7:]
+        elif text[:3] == "```":
+            text = text[3:]
+        data = json_loads(text.rstrip().removesuffix("```"))
+
+    # Cleanup remote file off the critical path
+    cleanup_executor.submit(delete_remote_file, video_file.name)
+
+    return data
+
+# Remote deletes run one at a time in the background so they never delay a video
+cleanup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="brain-cleanup")
+
+def delete_remote_file(name):
+    try:
+        client.files.delete(name=name)
     except Exception as e:
-        logger.error(f"DB Error: {e}")
-        return None, None
+        logger.warning("Failed to delete remote file: %s", e, extra={"event": "cleanup_error", "remote_file": name})
+
+# (fetched_at, db_version, style, bgm_candidates) from the last trends.db read
+_style_cache = None
+_style_refreshing = threading.Event()
+
+def invalidate_style_cache(*_):
+    """Drop the cached style so the next video re-reads trends.db"""
+    global _style_cache
+    _style_cache = None
+
+def db_version():
+    """
+    PRAGMA data_version of the shared trends.db connection. It only changes when
+    another connection commits, so brain's own ledger writes do not count.
+    """
+    with _db_lock:
+        try:
+            conn = get_db()
+            if conn is None:
+                return None
+            return conn.execute("PRAGMA data_version").fetchone()[0]
+        except Exception as e:
+            logger.error("DB Error: %s", e)
+            return None
+
+def refresh_style_cache():
+    global _style_cache
+    version = db_version()
+    style, bgm_candidates = query_latest_style()
+    _style_cache = (time.monotonic(), version, style, bgm_candidates)
+    return _style_cache
+
+def refresh_style_cache_in_background():
+    try:
+        refresh_style_cache()
     finally:
-        conn.close()
+        _style_refreshing.clear()
+
+def fetch_latest_style():
+    """Return the latest trending style and a random matching BGM path"""
+    cached = _style_cache
+    if not cached or db_version() != cached[1]:
+        # Nothing cached yet, or trend_watcher has written since: read it now
+        cached = refresh_style_cache()
+    elif time.monotonic() - cached[0] >= STYLE_CACHE_TTL and not _style_refreshing.is_set():
+        # Stale-while-revalidate: serve the old style and refresh in the background
+        _style_refreshing.set()
+        threading.Thread(target=refresh_style_cache_in_background, name="brain-style-refresh", daemon=True).start()
+
+    _, _, style, bgm_candidates = cached
+    bgm_path = random.choice(bgm_candidates) if bgm_candidates else None
+    return style, bgm_path
+
+_db_conn = None
+_db_lock = threading.Lock()
+
+def get_db():
+    """Return the shared trends.db connection, opening it on first use"""
+    global _db_conn
+    if _db_conn is None:
+        if not os.path.exists(DB_PATH):
+            return None
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        # WAL lets us read while trend_watcher is writing
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        # trend_watcher creates it too; an older trends.db may predate it
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS processed_files (
+                path TEXT PRIMARY KEY,
+                sha1 TEXT,
+                mtime REAL,
+                processed_at TIMESTAMP
+            )
+        """)
+        _db_conn = conn
+    return _db_conn
+
+def query_latest_style():
+    with _db_lock:
+        try:
+            conn = get_db()
+            if conn is None:
+                return None, []
+
+            # Get latest style
+            style = conn.execute("SELECT * FROM styles ORDER BY created_at DESC, id DESC LIMIT 1").fetchone()
+
+            bgm_candidates = []
+            if style:
+                # Collect every matching BGM once; the pick happens per video in memory
+                bgm_mood = style['bgm_mood']
+                if bgm_mood:
+                    rows = conn.execute("SELECT path FROM assets WHERE type='bgm' AND tags LIKE ?", (f"%{bgm_mood}%",)).fetchall()
+                    bgm_candidates = [row['path'] for row in rows]
+
+            return dict(style) if style else None, bgm_candidates
+
+        except Exception as e:
+            logger.error("DB Error: %s", e)
+            return None, []
+
+def is_processed(path, fingerprint):
+    """True if the ledger in trends.db has path recorded with this fingerprint"""
+    with _db_lock:
+        try:
+            conn = get_db()
+            if conn is None:
+                return False
+            row = conn.execute("SELECT sha1 FROM processed_files WHERE path = ?", (path,)).fetchone()
+            return row is not None and row['sha1'] == fingerprint
+        except Exception as e:
+            logger.error("DB Error: %s", e)
+            return False
+
+def mark_processed(path, fingerprint, mtime):
+    with _db_lock:
+        try:
+            conn = get_db()
+            if conn is None:
+                return
+            conn.execute(
+                "INSERT OR REPLACE INTO processed_files (path, sha1, mtime, processed_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
+                (path, fingerprint, mtime),
+            )
+        except Exception as e:
+            logger.error("DB Error: %s", e)
+
+def is_video(path):
+    return os.path.splitext(path)[1].lower() in VIDEO_EXTS
+
+def is_new_video(change, path):
+    """watchfiles filter: only files added to RAW_DIR with a video extension"""
+    return change == Change.added and is_video(path)
+
+def is_network_fs(path):
+    """Return True if path lives on a network filesystem (Linux only)"""
+    path = os.path.realpath(path)
+    best_mount, best_type = "", ""
+    try:
+        with open("/proc/mounts", "r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point, fs_type = fields[1], fields[2]
+                if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) \
+                        and len(mount_point) > len(best_mount):
+                    best_mount, best_type = mount_point, fs_type
+    except OSError:
+        return False
+    return best_type in NETWORK_FS_TYPES
+
+def scan_existing(handler):
+    """Process videos dropped while the service was not watching"""
+    analysed = set(os.listdir(JSON_DIR))
+    # DirEntry caches the file type from readdir, so no extra stat per file
+    with os.scandir(RAW_DIR) as it:
+        entries = sorted((e for e in it if is_video(e.name) and e.is_file()), key=lambda e: e.name)
+    for entry in entries:
+        if f"{entry.name}.json" in analysed:
+            continue
+        handler.dispatch_path(entry.path)
+
+def hash_file(path):
+    """BLAKE2b digest of a file, read in 1 MiB chunks"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def fingerprint_file(path):
+    """
+    Cheap identity for the processed-files ledger: SHA-1 over the size, the first
+    and last 1 MiB of the video, and its metadata sidecar. Returns (sha1, mtime).
+    """
+    st = os.stat(path)
+    h = hashlib.sha1(str(st.st_size).encode())
+    with open(path, "rb") as f:
+        h.update(f.read(1 << 20))
+        if st.st_size > 2 << 20:
+            f.seek(-(1 << 20), os.SEEK_END)
+            h.update(f.read())
+        elif st.st_size > 1 << 20:
+            h.update(f.read())
+    try:
+        with open(path + "_metadata.json", "rb") as f:
+            h.update(f.read())
+    except FileNotFoundError:
+        pass
+    return h.hexdigest(), st.st_mtime
+
+def analysis_cache_key(video_hash, metadata, style):
+    """Combine the video hash with the inputs that shape the prompt"""
+    # manual_instructions is left out: merge_instructions applies it after Gemini
+    prompt_inputs = {}
+    if metadata:
+        prompt_inputs = {field: metadata[field] for field in ("script", "options") if metadata.get(field)}
+    if style:
+        prompt_inputs["style"] = {field: style.get(field) for field in STYLE_PROMPT_FIELDS}
+    if not prompt_inputs:
+        return video_hash
+    h = hashlib.blake2b(video_hash.encode(), digest_size=16)
+    h.update(json_dumps_pretty(prompt_inputs))
+    return h.hexdigest()
+
+def load_cached_analysis(cache_key):
+    cache_path = os.path.join(ANALYSIS_CACHE_DIR, f"{cache_key}.json")
+    try:
+        with open(cache_path, "rb") as f:
+            data = json_loads(f.read())
+    except (OSError, ValueError):
+        return None
+    # Refresh mtime so eviction is least-recently-used
+    os.utime(cache_path)
+    return data
+
+def store_cached_analysis(cache_key, data):
+    try:
+        os.makedirs(ANALYSIS_CACHE_DIR, exist_ok=True)
+        cache_path = os.path.join(ANALYSIS_CACHE_DIR, f"{cache_key}.json")
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(json_dumps_pretty(data))
+        os.replace(tmp_path, cache_path)
+        evict_analysis_cache()
+    except OSError as e:
+        logger.error("Failed to cache analysis: %s", e)
+
+def evict_analysis_cache():
+    """Drop the least recently used entries beyond ANALYSIS_CACHE_MAX"""
+    with os.scandir(ANALYSIS_CACHE_DIR) as it:
+        entries = [e for e in it if e.name.endswith(".json")]
+    if len(entries) <= ANALYSIS_CACHE_MAX:
+        return
+    entries.sort(key=lambda e: e.stat().st_mtime)
+    for entry in entries[:len(entries) - ANALYSIS_CACHE_MAX]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
 
 def load_metadata(video_path):
     """Load metadata JSON file if it exists"""
     metadata_path = video_path + "_metadata.json"
-    if os.path.exists(metadata_path):
-        try:
-            with open(metadata_path, 'r') as f:
-                return json.load(f)
-        except Exception as e:
-            logger.error(f"Failed to load metadata: {e}")
+    try:
+        with open(metadata_path, 'rb') as f:
+            return json_loads(f.read())
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error("Failed to load metadata: %s", e)
     return None
 
 def extract_audio(video_path):
     """Extract audio from video for analysis"""
     audio_path = video_path.replace(Path(video_path).suffix, "_audio.wav")
     try:
+        # Reuses the cached probe; skips spawning ffmpeg for silent videos
+        if not probe(video_path)[2]:
+            return None
         subprocess.run([
             "ffmpeg", "-y", "-i", video_path,
             "-vn", "-acodec", "pcm_s16le", "-ar", "16000", "-ac", "1",
@@ -327,9 +845,19 @@ def extract_audio(video_path):
         ], check=True, capture_output=True)
         return audio_path
     except Exception as e:
-        logger.error(f"Audio extraction failed: {e}")
+        logger.error("Audio extraction failed: %s", e)
         return None
 
+def hms_to_s(timestamp):
+    """Convert 'HH:MM:SS' (or 'MM:SS', fractions allowed) to seconds; NaN if unparsable"""
+    seconds = 0.0
+    try:
+        for part in str(timestamp).split(":"):
+            seconds = seconds * 60 + float(part)
+    except ValueError:
+        return math.nan
+    return seconds
+
 def merge_instructions(ai_data, manual_instructions):
     """Merge manual instructions with AI analysis, prioritizing user instructions"""
     if not manual_instructions:
@@ -342,25 +870,62 @@ def merge_instructions(ai_data, manual_instructions):
     
     # Apply manual cuts (remove or keep specific segments)
     if manual_cuts:
+        # Remove windows sorted by start, with the furthest end reached so far
+        windows = []
         for manual_cut in manual_cuts:
             if manual_cut["action"] == "remove":
-                # Remove AI-generated cuts that fall within this timeframe
-                ai_data["cuts"] = [
-                    cut for cut in ai_data["cuts"]
-                    if not (cut["start_time"] >= manual_cut["start"] and cut["end_time"] <= manual_cut["end"])
-                ]
+                start, end = hms_to_s(manual_cut["start"]), hms_to_s(manual_cut["end"])
+                if not (math.isnan(start) or math.isnan(end)):
+                    windows.append((start, end))
+        if windows:
+            windows.sort()
+            window_starts = [start for start, _ in windows]
+            max_ends = list(itertools.accumulate((end for _, end in windows), max))
+
+            # Remove AI-generated cuts that fall within any of these timeframes:
+            # some window starting at or before the cut must also reach its end
+            kept = []
+            for cut in ai_data["cuts"]:
+                i = bisect.bisect_right(window_starts, hms_to_s(cut["start_time"]))
+                if not (i and max_ends[i - 1] >= hms_to_s(cut["end_time"])):
+                    kept.append(cut)
+            ai_data["cuts"] = kept
     
     # Add manual captions to cuts
     if manual_captions:
+        cuts = ai_data["cuts"]
+        spans = [(hms_to_s(cut["start_time"]), hms_to_s(cut["end_time"])) for cut in cuts]
+
+        # Bisect only when the cuts are in order and do not overlap (Gemini's usual
+        # output); otherwise keep the first-match scan so overlapping cuts still match
+        ordered = True
+        max_end = -math.inf
+        for start, end in spans:
+            if not start >= max_end:  # also catches NaN
+                ordered = False
+                break
+            max_end = max(max_end, end)
+        span_starts = [start for start, _ in spans] if ordered else None
+
         for manual_cap in manual_captions:
             # Find the cut that contains this timestamp and add caption
-            for cut in ai_data["cuts"]:
-                if cut["start_time"] <= manual_cap["timestamp"] <= cut["end_time"]:
-                    cut["caption"] = manual_cap["text"]
-                    if "caption_style" not in cut:
-                        cut["caption_style"] = {}
-                    cut["caption_style"]["color"] = manual_cap["style"]
-                    break
+            timestamp = hms_to_s(manual_cap["timestamp"])
+            if ordered:
+                i = bisect.bisect_right(span_starts, timestamp) - 1
+                # A timestamp on a shared boundary belongs to the earlier cut
+                while i > 0 and spans[i - 1][1] >= timestamp:
+                    i -= 1
+                if i < 0 or not spans[i][0] <= timestamp <= spans[i][1]:
+                    continue
+            else:
+                i = next((j for j, (start, end) in enumerate(spans) if start <= timestamp <= end), None)
+                if i is None:
+                    continue
+            cut = cuts[i]
+            cut["caption"] = manual_cap["text"]
+            if "caption_style" not in cut:
+                cut["caption_style"] = {}
+            cut["caption_style"]["color"] = manual_cap["style"]
     
     # Add manual effects
     if manual_effects:
@@ -376,32 +941,64 @@ def merge_instructions(ai_data, manual_instructions):
     
     return ai_data
 
+@functools.lru_cache(maxsize=256)
+def probe_media(video_path, mtime, size):
+    """Run ffprobe once per file version; returns (duration, nb_streams, has_audio)"""
+    result = subprocess.run([
+        "ffprobe", "-v", "error", "-show_format", "-show_streams",
+        "-print_format", "json", video_path
+    ], capture_output=True, check=True)
+    info = json_loads(result.stdout)
+    streams = info.get("streams", [])
+    duration = float(info.get("format", {}).get("duration", 0) or 0)
+    has_audio = any(stream.get("codec_type") == "audio" for stream in streams)
+    return duration, len(streams), has_audio
+
+def probe(video_path):
+    # mtime and size are part of the cache key so a replaced file is probed again
+    st = os.stat(video_path)
+    return probe_media(video_path, st.st_mtime, st.st_size)
+
 def calculate_video_duration(video_path):
     """Get video duration in seconds"""
     try:
-        result = subprocess.run([
-            "ffprobe", "-v", "error", "-show_entries",
-            "format=duration", "-of", "default=noprint_wrappers=1:nokey=1",
-            video_path
-        ], capture_output=True, text=True, check=True)
-        return float(result.stdout.strip())
-    except:
+        return probe(video_path)[0]
+    except Exception:
         return 60  # Default to 60 seconds if ffprobe fails
 
 if __name__ == "__main__":
     os.makedirs(RAW_DIR, exist_ok=True)
     os.makedirs(JSON_DIR, exist_ok=True)
 
-    event_handler = VideoHandler()
-    observer = Observer()
-    observer.schedule(event_handler, RAW_DIR, recursive=False)
-    observer.start()
-    
-    logger.info(f"Brain service started", extra={"event": "startup", "watched_dir": RAW_DIR, "model": MODEL_NAME})
-    
+    # `kill -HUP` forces the next video to pick up a freshly crawled style
+    signal.signal(signal.SIGHUP, invalidate_style_cache)
+
+    # Videos are processed concurrently on an event loop in a background thread
+    loop = asyncio.new_event_loop()
+    # A video can hold two threads at once (upload + style fetch)
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=BRAIN_WORKERS * 2, thread_name_prefix="brain-worker"))
+    loop_thread = threading.Thread(target=loop.run_forever, name="brain-loop", daemon=True)
+    loop_thread.start()
+
+    handler = VideoHandler(loop)
+    # inotify misses writes from other hosts on NFS/CIFS; WATCH_POLL=1 forces polling anywhere
+    polling = os.environ.get("WATCH_POLL") == "1" or is_network_fs(RAW_DIR)
+
+    logger.info("Brain service started", extra={"event": "startup", "watched_dir": RAW_DIR, "model": MODEL_NAME, "polling": polling})
+
+    threading.Thread(target=watch_bgm_dir, args=(polling,), name="brain-bgm-watch", daemon=True).start()
+
     try:
-        while True:
-            time.sleep(1)
+        scanned = False
+        # yield_on_timeout: the first (possibly empty) yield comes once the watcher is armed
+        for changes in watch(RAW_DIR, watch_filter=is_new_video, force_polling=polling, recursive=False, yield_on_timeout=True):
+            if not scanned:
+                # Catch files dropped while the service was down; anything created
+                # from here on is also reported by the watcher, and dispatch_path dedups
+                scan_existing(handler)
+                scanned = True
+            for _, path in changes:
+                handler.dispatch_path(path)
     except KeyboardInterrupt:
-        observer.stop()
-    observer.join()
+        pass
+    loop.call_soon_threadsafe(loop.stop)
@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import uuid
+import logging
+import tempfile
+import threading
+from concurrent.futures import Future
+from google.genai import types
+
+logger = logging.getLogger(__name__)
+
+# Terminal states reported by client.batches.get
+DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+
+class BatchQueue:
+    """
+    Collects generate_content requests and submits them as one Gemini batch job.
+
+    A batch is flushed when it holds max_size requests or when the oldest request
+    has waited flush_sec seconds. Each submit() returns a Future resolving to the
+    response text for that request.
+    """
+
+    def __init__(self, client, model, max_size, flush_sec, generation_config=None, poll_sec=30):
+        self.client = client
+        self.model = model
+        self.max_size = max_size
+        self.flush_sec = flush_sec
+        self.generation_config = generation_config or {"response_mime_type": "application/json"}
+        self.poll_sec = poll_sec
+        self.items = []
+        self.first_queued_at = None
+        self.cond = threading.Condition()
+        threading.Thread(target=self._flush_loop, name="brain-batch", daemon=True).start()
+
+    def submit(self, video_file, prompt):
+        future = Future()
+        with self.cond:
+            first = not self.items
+            if first:
+                self.first_queued_at = time.monotonic()
+            self.items.append((uuid.uuid4().hex, video_file, prompt, future))
+            # Wake the flush loop to start the flush_sec timer, or because the batch is full
+            if first or len(self.items) >= self.max_size:
+                self.cond.notify()
+        return future
+
+    def _flush_loop(self):
+        while True:
+            with self.cond:
+                while not self.items:
+                    self.cond.wait()
+                # Wait for the batch to fill up or for the oldest item to time out
+                while len(self.items) < self.max_size:
+                    remaining = self.first_queued_at + self.flush_sec - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                items, self.items = self.items, []
+
+            # Jobs run in their own thread so the next batch can start filling
+            threading.Thread(target=self._run_batch, args=(items,), daemon=True).start()
+
+    def _run_batch(self, items):
+        futures = {key: future for key, _, _, future in items}
+        jsonl_path = None
+        src_file = None
+        try:
+            jsonl_path = self._write_requests(items)
+            src_file = self.client.files.upload(
+                file=jsonl_path,
+                config=types.UploadFileConfig(display_name=os.path.basename(jsonl_path), mime_type="jsonl"),
+            )
+            job = self.client.batches.create(model=self.model, src=src_file.name)
+            logger.info("Batch job submitted", extra={"event": "batch_submitted", "job": job.name, "size": len(items)})
+
+            while job.state.name not in DONE_STATES:
+                time.sleep(self.poll_sec)
+                job = self.client.batches.get(name=job.name)
+
+            if job.state.name != "JOB_STATE_SUCCEEDED":
+                raise RuntimeError(f"Batch job {job.name} ended in {job.state.name}")
+
+            output = self.client.files.download(file=job.dest.file_name)
+            for line in output.decode("utf-8").splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    result = json.loads(line)
+                except ValueError as e:
+                    logger.warning("Unreadable batch output line", extra={"event": "batch_line_error", "job": job.name, "error": str(e)})
+                    continue
+                key = result.get("key")
+                future = futures.get(key)
+                if future is None:
+                    continue
+                if "error" in result:
+                    resolve(future, exception=RuntimeError(f"Batch request failed: {result['error']}"))
+                else:
+                    # A blocked request comes back without candidates; fail only that video
+                    try:
+                        resolve(future, result=response_text(result["response"]))
+                    except (KeyError, IndexError, TypeError) as e:
+                        resolve(future, exception=RuntimeError(f"Batch request returned no usable response: {e!r}"))
+                del futures[key]
+
+            logger.info("Batch job finished", extra={"event": "batch_complete", "job": job.name})
+        except Exception as e:
+            logger.error("Batch job failed", extra={"event": "batch_error", "error": str(e)})
+            for future in futures.values():
+                resolve(future, exception=e)
+            futures = {}
+        finally:
+            for future in futures.values():
+                resolve(future, exception=RuntimeError("No result returned for batch request"))
+            if jsonl_path:
+                os.remove(jsonl_path)
+            if src_file:
+                try:
+                    self.client.files.delete(name=src_file.name)
+                except Exception:
+                    pass
+
+    def _write_requests(self, items):
+        fd, path = tempfile.mkstemp(prefix="brain-batch-", suffix=".jsonl")
+        with os.fdopen(fd, "w") as f:
+            for key, video_file, prompt, _ in items:
+                request = {
+                    "contents": [{
+                        "role": "user",
+                        "parts": [
+                            {"file_data": {"file_uri": video_file.uri, "mime_type": video_file.mime_type}},
+                            {"text": prompt},
+                        ],
+                    }],
+                    "generation_config": self.generation_config,
+                }
+                f.write(json.dumps({"key": key, "request": request}))
+                f.write("\n")
+        return path
+
+
+def resolve(future, result=None, exception=None):
+    # The waiting coroutine may have been cancelled in the meantime
+    if future.done():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+
+def response_text(response):
+    """Concatenate the text parts of the first candidate of a raw GenerateContentResponse"""
+    parts = response["candidates"][0]["content"]["parts"]
+    return "".join(part.get("text", "") for part in parts)
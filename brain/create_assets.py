@@ -1,18 +1,17 @@
-from PIL import Image, ImageDraw
+import os
+from PIL import Image
+
+ASSET_DIR = "/app/data/assets/caption_bg"
 
 def create_box(filename, color, opacity):
     # Create a 1920x300 box (lower third)
-    # RGBA
-    img = Image.new('RGBA', (1920, 300), (0, 0, 0, 0))
-    draw = ImageDraw.Draw(img)
-    
-    # Draw semi-transparent box
+    # RGBA, filled with the semi-transparent color in a single pass
     r, g, b = color
-    draw.rectangle([0, 0, 1920, 300], fill=(r, g, b, int(255 * opacity)))
-    
-    img.save(filename)
+    img = Image.new('RGBA', (1920, 300), (r, g, b, int(255 * opacity)))
+    img.save(filename, optimize=True)
 
 if __name__ == "__main__":
-    create_box("/app/data/assets/caption_bg/simple_box.png", (0, 0, 0), 0.6)
-    create_box("/app/data/assets/caption_bg/news_ticker.png", (0, 0, 150), 0.8)
+    os.makedirs(ASSET_DIR, exist_ok=True)
+    create_box(os.path.join(ASSET_DIR, "simple_box.png"), (0, 0, 0), 0.6)
+    create_box(os.path.join(ASSET_DIR, "news_ticker.png"), (0, 0, 150), 0.8)
     print("Assets created")
@@ -0,0 +1,58 @@
+import json
+import time
+import unittest
+from types import SimpleNamespace
+
+from batch import BatchQueue
+
+
+class FakeFiles:
+    def __init__(self):
+        self.uploads = 0
+        self.keys = []
+
+    def upload(self, file, config):
+        self.uploads += 1
+        with open(file) as f:
+            self.keys = [json.loads(line)["key"] for line in f]
+        return SimpleNamespace(name="files/src")
+
+    def download(self, file):
+        lines = [
+            json.dumps({"key": key, "response": {"candidates": [{"content": {"parts": [{"text": "{}"}]}}]}})
+            for key in self.keys
+        ]
+        return "\n".join(lines).encode("utf-8")
+
+    def delete(self, name):
+        pass
+
+
+def fake_client():
+    job = SimpleNamespace(
+        name="batches/1",
+        state=SimpleNamespace(name="JOB_STATE_SUCCEEDED"),
+        dest=SimpleNamespace(file_name="files/out"),
+    )
+    return SimpleNamespace(
+        files=FakeFiles(),
+        batches=SimpleNamespace(create=lambda **_: job, get=lambda **_: job),
+    )
+
+
+class BatchQueueTest(unittest.TestCase):
+    def test_partial_batch_flushes_after_flush_sec(self):
+        client = fake_client()
+        queue = BatchQueue(client, "model", max_size=5, flush_sec=0.2, poll_sec=0)
+        video_file = SimpleNamespace(uri="files/video", mime_type="video/mp4")
+
+        started = time.monotonic()
+        future = queue.submit(video_file, "prompt")
+
+        self.assertEqual(future.result(timeout=5), "{}")
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertEqual(client.files.uploads, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
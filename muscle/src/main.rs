@@ -1,6 +1,7 @@
 use anyhow::{Context, Result};
 use log::{error, info, LevelFilter};
-use notify::{Config, RecommendedWatcher, RecursiveMode, Watcher};
+use notify::event::ModifyKind;
+use notify::{Config, EventKind, RecommendedWatcher, RecursiveMode, Watcher};
 use serde::{Deserialize, Serialize};
 use std::fs;
 use std::io::Write;
@@ -170,7 +171,13 @@ fn main() -> Result<()> {
     for res in rx {
         match res {
             Ok(event) => {
-                if let notify::EventKind::Create(_) = event.kind {
+                // Brain writes analyses to a temp file and renames them into place.
+                // Backends report renames as To, Both or Any; the .json filter below
+                // drops the temp-file side, and a vanished source fails to read.
+                if matches!(
+                    event.kind,
+                    EventKind::Create(_) | EventKind::Modify(ModifyKind::Name(_))
+                ) {
                     for path in event.paths {
                         if path.extension().map_or(false, |ext| ext == "json") {
                             log_json("INFO", "New analysis detected", Some("file_detected"), Some(path.to_str().unwrap_or("")));
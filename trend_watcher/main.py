@@ -1,9 +1,25 @@
 import os
 import sys
+import json
+import time
 import sqlite3
 import logging
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import yt_dlp
+from google import genai
+from google.genai import types
 from pythonjsonlogger import jsonlogger
+from dotenv import load_dotenv
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+load_dotenv()
 
 # Configure logging
 logger = logging.getLogger()
@@ -14,14 +30,38 @@ logger.addHandler(logHandler)
 logger.setLevel(logging.INFO)
 
 DB_PATH = "/app/data/trends.db"
+# Number of search results downloaded and analyzed in parallel
+CRAWL_WORKERS = int(os.environ.get("CRAWL_WORKERS", "4"))
+# Finished videos (and their styles) are committed in groups of this size
+CRAWL_COMMIT_EVERY = int(os.environ.get("CRAWL_COMMIT_EVERY", "10"))
 
-import yt_dlp
+# Serializes access to the sqlite connection shared by crawl workers
+db_lock = threading.Lock()
+# Asset URLs already being downloaded by some worker (guarded by db_lock)
+claimed_asset_urls = set()
+# Per-thread YoutubeDL handles, keyed by purpose ('sample', 'bgm', 'se')
+ydl_local = threading.local()
+
+def get_ydl(key, ydl_opts):
+    """Return this thread's YoutubeDL for key, creating it on first use"""
+    # YoutubeDL instances are not thread-safe, so each worker keeps its own
+    handles = ydl_local.__dict__.setdefault("handles", {})
+    ydl = handles.get(key)
+    if ydl is None:
+        ydl = handles[key] = yt_dlp.YoutubeDL(ydl_opts)
+    return ydl
 
-# ... logging setup ...
+def connect_db(**kwargs):
+    conn = sqlite3.connect(DB_PATH, **kwargs)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
 
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    conn = connect_db()
     cursor = conn.cursor()
+
+    # WAL is persistent in the file: brain can read styles while a crawl is writing
+    cursor.execute("PRAGMA journal_mode=WAL")
     
     # Styles table
     cursor.execute('''
@@ -51,6 +91,9 @@ def init_db():
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )
     ''')
+    # brain filters BGM by type + tags; download_asset dedups by source_url
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_assets_type_tags ON assets(type, tags)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_assets_source_url ON assets(source_url)')
 
     # Source Videos table
     cursor.execute('''
@@ -64,36 +107,49 @@ def init_db():
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )
     ''')
+
+    # Videos brain has already analyzed, so restarts and re-sweeps skip them
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS processed_files (
+        path TEXT PRIMARY KEY,
+        sha1 TEXT,
+        mtime REAL,
+        processed_at TIMESTAMP
+    )
+    ''')
     
     conn.commit()
     conn.close()
     logger.info("Database initialized", extra={"event": "db_init", "path": DB_PATH})
 
-import json
-from google import genai
-from google.genai import types
-from dotenv import load_dotenv
-
-load_dotenv()
 API_KEY = os.environ.get("GEMINI_API_KEY")
 
+# Shared by the crawl workers
+client = genai.Client(api_key=API_KEY) if API_KEY else None
+
+def wait_for_file_ready(video_file, timeout=600):
+    """Poll an uploaded file until Gemini finishes processing it, backing off between probes"""
+    deadline = time.monotonic() + timeout
+    delay = 0.25
+    while video_file.state.name == "PROCESSING":
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"Gemini did not finish processing {video_file.name} within {timeout}s")
+        time.sleep(delay)
+        delay = min(delay * 1.6, 4.0)
+        video_file = client.files.get(name=video_file.name)
+    return video_file
+
 def analyze_video(filepath, genre):
-    if not API_KEY:
+    if not client:
         logger.error("GEMINI_API_KEY not set")
         return None
-        
-    client = genai.Client(api_key=API_KEY)
     
     try:
         logger.info("Uploading for analysis...", extra={"event": "upload_start", "path": filepath})
-        video_file = client.files.upload(file=filepath)
+        # Streamed in resumable chunks by the SDK; samples are always mp4
+        video_file = client.files.upload(file=filepath, config={"mime_type": "video/mp4"})
         
-        # Wait for processing
-        import time
-        while video_file.state.name == "PROCESSING":
-            time.sleep(2)
-            video_file = client.files.get(name=video_file.name)
-            
+        video_file = wait_for_file_ready(video_file)
         if video_file.state.name == "FAILED":
             logger.error("Video processing failed")
             return None
@@ -124,7 +180,7 @@ def analyze_video(filepath, genre):
         except:
             pass
 
-        return json.loads(response.text)
+        return json_loads(response.text)
         
     except Exception as e:
         logger.error(f"Analysis failed: {e}")
@@ -145,40 +201,103 @@ def download_asset(query, asset_type, cursor, conn):
     }
     
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            # Search 1 candidate
-            result = ydl.extract_info(f"ytsearch1:{query}", download=False)
-            
-            if 'entries' in result and result['entries']:
-                entry = result['entries'][0]
-                video_id = entry.get('id')
-                title = entry.get('title')
-                webpage_url = entry.get('webpage_url')
-                
-                # Check duplication in assets
+        ydl = get_ydl(asset_type, ydl_opts)
+        # Search 1 candidate
+        result = ydl.extract_info(f"ytsearch1:{query}", download=False)
+
+        if result and result.get('entries'):
+            entry = result['entries'][0]
+            video_id = entry.get('id')
+            title = entry.get('title')
+            webpage_url = entry.get('webpage_url')
+
+            # Check duplication in assets
+            with db_lock:
                 cursor.execute('SELECT id FROM assets WHERE source_url = ?', (webpage_url,))
-                if cursor.fetchone():
-                    logger.info("Asset already exists", extra={"title": title})
-                    return
-
-                logger.info(f"Downloading asset: {title}")
-                ydl.download([webpage_url])
-                
-                # Save to DB
-                # Extension unknown without post-processing, use simple glob or similar if needed for exact path
-                # For now, store the expected path pattern (yt-dlp uses video_id)
-                file_path = f"{asset_dir}/{video_id}" 
-                
+                exists = cursor.fetchone() or webpage_url in claimed_asset_urls
+                # Claim it so a parallel worker does not download the same asset
+                claimed_asset_urls.add(webpage_url)
+            if exists:
+                logger.info("Asset already exists", extra={"title": title})
+                return
+
+            logger.info(f"Downloading asset: {title}")
+            # The search already resolved the entry; download it without re-extracting the page
+            ydl.process_ie_result(entry, download=True)
+
+            # Save to DB
+            # Extension unknown without post-processing, use simple glob or similar if needed for exact path
+            # For now, store the expected path pattern (yt-dlp uses video_id)
+            file_path = f"{asset_dir}/{video_id}"
+
+            with db_lock:
                 cursor.execute('''
                     INSERT INTO assets (type, name, path, tags, source_url)
                     VALUES (?, ?, ?, ?, ?)
                 ''', (asset_type, title, file_path, query, webpage_url))
                 conn.commit()
-                logger.info("Asset saved", extra={"title": title})
-                
+            logger.info("Asset saved", extra={"title": title})
+
     except Exception as e:
         logger.error(f"Asset download failed: {e}")
 
+def crawl_entry(entry, genre, sample_dir, ydl_opts, cursor, conn):
+    """Download and analyze a single search result, returning its styles row (or None)"""
+    video_id = entry.get('id')
+    title = entry.get('title')
+
+    logger.info(f"Processing: {title}")
+
+    # Download sample
+    logger.info(f"Downloading sample for {video_id}...")
+    if entry.get('webpage_url'):
+        # The search already resolved the entry; download it without re-extracting the page
+        get_ydl("sample", ydl_opts).process_ie_result(entry, download=True)
+    else:
+        logger.warning(f"No URL found for {video_id}")
+        return
+
+    # File path
+    filename = f"{video_id}.mp4"
+    filepath = os.path.join(sample_dir, filename)
+
+    style_row = None
+    if os.path.exists(filepath):
+        # Analyze
+        logger.info("Analyzing style...")
+        style = analyze_video(filepath, genre)
+
+        if style:
+            # Written by crawl() together with the other results
+            style_row = (
+                genre,
+                style.get('cuts_per_min', 0),
+                style.get('avg_shot_duration', 0),
+                style.get('filter_usage', 'none'),
+                style.get('transition_type', 'cut'),
+                style.get('caption_style', 'none'),
+                style.get('bgm_mood', 'unknown'),
+                json.dumps(style.get('se_tags', []))
+            )
+            logger.info("Style analyzed", extra={"style": style})
+
+            # Collect Assets
+            # BGM
+            bgm_mood = style.get('bgm_mood')
+            if bgm_mood:
+                download_asset(f"No copyright music {bgm_mood}", "bgm", cursor, conn)
+
+            # SE
+            se_tags = style.get('se_tags', [])
+            for tag in se_tags:
+                if tag and tag != "none":
+                    download_asset(f"Sound effect {tag}", "se", cursor, conn)
+
+        # Cleanup sample to save space
+        os.remove(filepath)
+
+    return style_row
+
 def crawl(genre, limit):
     logger.info(f"Starting crawl for genre: {genre}", extra={"event": "crawl_start", "genre": genre, "limit": limit})
     
@@ -197,7 +316,8 @@ def crawl(genre, limit):
 
     search_query = f"ytsearch{limit}:{genre} vlog"
 
-    conn = sqlite3.connect(DB_PATH)
+    # Shared by the worker threads; every use is guarded by db_lock
+    conn = connect_db(check_same_thread=False)
     cursor = conn.cursor()
 
     try:
@@ -205,78 +325,63 @@ def crawl(genre, limit):
             # First extract info to check dupes
             logger.info("Searching...", extra={"event": "search_start"})
             result = ydl.extract_info(search_query, download=False)
-            
-            if 'entries' in result:
-                for entry in result['entries']:
-                    if not entry: continue
-                    
-                    video_id = entry.get('id')
-                    title = entry.get('title')
-                    
-                    # Check duplication
-                    cursor.execute('SELECT id FROM source_videos WHERE video_id = ?', (video_id,))
-                    if cursor.fetchone():
-                        logger.info("Skipping duplicate", extra={"video_id": video_id})
-                        continue
-
-                    logger.info(f"Processing: {title}")
-                    
-                    # Record video
-                    cursor.execute('''
-                        INSERT INTO source_videos (video_id, title, genre, view_count)
-                        VALUES (?, ?, ?, ?)
-                    ''', (video_id, title, genre, entry.get('view_count', 0)))
-                    conn.commit()
-
-                    # Download sample
-                    logger.info(f"Downloading sample for {video_id}...")
-                    url = entry.get('webpage_url')
-                    if url:
-                         ydl.download([url])
-                    else:
-                         logger.warning(f"No URL found for {video_id}")
-                         continue
-                    
-                    # File path
-                    filename = f"{video_id}.mp4"
-                    filepath = os.path.join(sample_dir, filename)
-                    
-                    if os.path.exists(filepath):
-                        # Analyze
-                        logger.info("Analyzing style...")
-                        style = analyze_video(filepath, genre)
-                        
-                        if style:
-                            cursor.execute('''
-                                INSERT INTO styles (genre, cuts_per_min, avg_shot_duration, filter_usage, transition_type, caption_style, bgm_mood, se_tags)
-                                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                            ''', (
-                                genre,
-                                style.get('cuts_per_min', 0),
-                                style.get('avg_shot_duration', 0),
-                                style.get('filter_usage', 'none'),
-                                style.get('transition_type', 'cut'),
-                                style.get('caption_style', 'none'),
-                                style.get('bgm_mood', 'unknown'),
-                                json.dumps(style.get('se_tags', []))
-                            ))
-                            conn.commit()
-                            logger.info("Style saved", extra={"style": style})
-
-                            # Collect Assets
-                            # BGM
-                            bgm_mood = style.get('bgm_mood')
-                            if bgm_mood:
-                                download_asset(f"No copyright music {bgm_mood}", "bgm", cursor, conn)
-                            
-                            # SE
-                            se_tags = style.get('se_tags', [])
-                            for tag in se_tags:
-                                if tag and tag != "none":
-                                    download_asset(f"Sound effect {tag}", "se", cursor, conn)
-                        
-                        # Cleanup sample to save space
-                        os.remove(filepath)
+
+        # Keyed by video_id, which also drops repeats within the search itself
+        entries = {entry.get('id'): entry for entry in (result or {}).get('entries') or [] if entry}
+
+        # Check duplication against earlier crawls in one query
+        if entries:
+            placeholders = ",".join("?" * len(entries))
+            with db_lock:
+                cursor.execute(f'SELECT video_id FROM source_videos WHERE video_id IN ({placeholders})', list(entries))
+                duplicates = cursor.fetchall()
+            for (video_id,) in duplicates:
+                logger.info("Skipping duplicate", extra={"video_id": video_id})
+                del entries[video_id]
+
+        # A video is recorded in the same transaction as its style, so an interrupted
+        # crawl leaves unfinished videos unrecorded and the next crawl retries them
+        video_rows, style_rows = [], []
+
+        def save_results():
+            with db_lock:
+                cursor.executemany('''
+                    INSERT OR IGNORE INTO source_videos (video_id, title, genre, view_count)
+                    VALUES (?, ?, ?, ?)
+                ''', video_rows)
+                cursor.executemany('''
+                    INSERT INTO styles (genre, cuts_per_min, avg_shot_duration, filter_usage, transition_type, caption_style, bgm_mood, se_tags)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', style_rows)
+                conn.commit()
+            logger.info("Styles saved", extra={"event": "styles_saved", "videos": len(video_rows), "count": len(style_rows)})
+            video_rows.clear()
+            style_rows.clear()
+
+        # Each entry is download + upload + analysis, all network-bound
+        try:
+            with ThreadPoolExecutor(max_workers=CRAWL_WORKERS) as executor:
+                futures = {
+                    executor.submit(crawl_entry, entry, genre, sample_dir, ydl_opts, cursor, conn): video_id
+                    for video_id, entry in entries.items()
+                }
+                for future in as_completed(futures):
+                    video_id = futures[future]
+                    entry = entries[video_id]
+                    # Failed videos are recorded too, as before, so they are not retried forever
+                    video_rows.append((video_id, entry.get('title'), genre, entry.get('view_count', 0)))
+                    try:
+                        style_row = future.result()
+                    except Exception as e:
+                        logger.error(f"Crawl entry failed: {e}", extra={"event": "crawl_error", "video_id": video_id, "error": str(e)})
+                        style_row = None
+                    if style_row:
+                        style_rows.append(style_row)
+                    if len(video_rows) >= CRAWL_COMMIT_EVERY:
+                        save_results()
+        finally:
+            if video_rows:
+                save_results()
 
     except Exception as e:
         logger.error(f"Crawl failed: {e}", extra={"event": "crawl_error", "error": str(e)})
@@ -307,7 +412,6 @@ def main():
     else:
         # Default behavior: run as a service/cron? Or just exit for now.
         logger.info("No command specified, running idle loop...", extra={"event": "idle"})
-        import time
         while True:
             time.sleep(3600)
 